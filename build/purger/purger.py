@@ -1,16 +1,41 @@
+import functools
+import gzip
+import itertools
 import json
+import os
+import random
+import re
+import stat
 import sys
+import tempfile
 import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Any, Dict, List, Optional, TextIO, cast
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Set,
+    TextIO,
+    Tuple,
+)
 from urllib.parse import urlparse
 
 import click
 import docker
+import orjson
 import requests
 import yaml
+from docker.errors import APIError
+from docker.models.containers import Container
 from matrix_client.errors import MatrixError
 from typing_extensions import TypedDict
 
@@ -20,14 +45,33 @@ from raiden.network.transport.matrix.client import GMatrixHttpApi
 from raiden.settings import DEFAULT_MATRIX_KNOWN_SERVERS
 from raiden.utils.typing import ChainID
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore
+
 SYNAPSE_CONFIG_PATH = "/config/synapse.yaml"
+SYNAPSE_ADMIN_API_PATH = "/_synapse/admin/v1"
 USER_PURGING_THRESHOLD = 2 * 24 * 60 * 60  # 2 days
+SECONDS_PER_DAY = 24 * 60 * 60
 USER_ACTIVITY_PATH = Path("/config/user_activity.json")
+KNOWN_SERVERS_CACHE_PATH = Path("/config/known_servers.cache.json")
+GZIP_MAGIC_NUMBER = b"\x1f\x8b"
+MAX_WORKERS = 32
+# every deactivation with erase makes the user leave the broadcast rooms,
+# which is expensive on the server, so fewer of them run at the same time
+MAX_DEACTIVATION_WORKERS = 4
+# docker's client keeps 10 pooled connections
+MAX_CONTAINER_WORKERS = 8
+MAX_RETRY_DELAY = 30
+RETRY_TIMEOUT = 5 * 60
+DEACTIVATE_CONTENT = {"erase": True}
 
 
 class UserActivityInfo(TypedDict):
     last_update: int
     network_to_users: Dict[str, Dict[str, Any]]
+    discovery_rooms: Dict[str, str]
 
 
 @dataclass(frozen=True)
@@ -75,7 +119,11 @@ def purge(
         click.secho(f"Invalid credentials file: {ex}", fg="red")
         sys.exit(1)
 
-    api = GMatrixHttpApi(server)
+    # one pooled keep-alive connection per worker thread, otherwise
+    # concurrent requests would open (and drop) their own connections
+    api = GMatrixHttpApi(
+        server, pool_maxsize=MAX_WORKERS, retry_timeout=RETRY_TIMEOUT, retry_delay=_retry_delay
+    )
     try:
         response = api.login(
             "m.login.password", user=username, password=password, device_id="purger"
@@ -89,14 +137,15 @@ def purge(
         global_user_activity: UserActivityInfo = {
             "last_update": int(time.time()) - USER_PURGING_THRESHOLD - 1,
             "network_to_users": {},
+            "discovery_rooms": {},
         }
 
         try:
-            global_user_activity = json.loads(USER_ACTIVITY_PATH.read_text())
-        except JSONDecodeError:
-            click.secho(f"{USER_ACTIVITY_PATH} is not a valid JSON. Starting with empty list")
+            global_user_activity = read_user_activity(USER_ACTIVITY_PATH)
         except FileNotFoundError:
             click.secho(f"{USER_ACTIVITY_PATH} not found. Starting with empty list")
+        except ValueError:
+            click.secho(f"{USER_ACTIVITY_PATH} is not a valid JSON. Starting with empty list")
 
         # check if there are new networks to add
         for network in Networks:
@@ -107,7 +156,7 @@ def purge(
         new_global_user_activity = run_user_purger(api, global_user_activity)
 
         # write the updated user activity to file
-        USER_ACTIVITY_PATH.write_text(json.dumps(cast(Dict[str, Any], new_global_user_activity)))
+        write_user_activity(USER_ACTIVITY_PATH, new_global_user_activity)
     finally:
         if docker_restart_label:
             if not url_known_federation_servers:
@@ -115,9 +164,7 @@ def purge(
                 url_known_federation_servers = DEFAULT_MATRIX_KNOWN_SERVERS[Environment.PRODUCTION]
             # fetch remote whiltelist
             try:
-                remote_whitelist = json.loads(requests.get(url_known_federation_servers).text)[
-                    "all_servers"
-                ]
+                remote_whitelist = fetch_remote_whitelist(url_known_federation_servers)
             except (requests.RequestException, JSONDecodeError, KeyError) as ex:
                 click.secho(
                     f"Error while fetching whitelist: {ex!r}. "
@@ -128,30 +175,128 @@ def purge(
                 remote_whitelist = []
 
             client = docker.from_env()  # pylint: disable=no-member
-            for container in client.containers.list():
-                if container.attrs["State"]["Status"] != "running" or not container.attrs[
-                    "Config"
-                ]["Labels"].get(docker_restart_label):
-                    continue
-
-                try:
-                    # fetch local list from container's synapse config
-                    local_whitelist = yaml.safe_load(
-                        container.exec_run(["cat", SYNAPSE_CONFIG_PATH]).output
-                    )["federation_domain_whitelist"]
-
-                    # if list didn't change, don't proceed to restart container
-                    if local_whitelist and remote_whitelist == local_whitelist:
-                        continue
-
-                    click.secho(f"Whitelist changed. Restarting. new_list={remote_whitelist!r}")
-                except (KeyError, IndexError) as ex:
-                    click.secho(
-                        f"Error fetching container status: {ex!r}. Restarting anyway.",
-                        err=True,
+            containers = [
+                container
+                for container in client.containers.list()
+                if container.attrs["State"]["Status"] == "running"
+                and container.attrs["Config"]["Labels"].get(docker_restart_label)
+            ]
+            remote_servers = frozenset(remote_whitelist)
+            # reading the config is a process spawned inside each container,
+            # so query them concurrently and only restart afterwards
+            with ThreadPoolExecutor(max_workers=MAX_CONTAINER_WORKERS) as executor:
+                needs_restart = list(
+                    executor.map(
+                        functools.partial(_whitelist_changed, remote_servers=remote_servers),
+                        containers,
                     )
-                # restart container
-                container.restart(timeout=30)
+                )
+            for container, restart in zip(containers, needs_restart):
+                if restart:
+                    container.restart(timeout=30)
+
+
+def fetch_remote_whitelist(url: str) -> List[str]:
+    """
+    Fetches the list of known federation servers. The validators of the last
+    response are cached, so an unchanged list is not downloaded again.
+    """
+    cache: Dict[str, Any] = {}
+    try:
+        cache = orjson.loads(KNOWN_SERVERS_CACHE_PATH.read_bytes())
+    except (OSError, JSONDecodeError):
+        pass
+    if not isinstance(cache, dict):
+        cache = {}
+
+    headers: Dict[str, str] = {}
+    # only ask for a 304 if the cached list can be used in that case
+    if cache.get("url") == url and "all_servers" in cache:
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+    response = requests.get(url, headers=headers, timeout=10)
+    if response.status_code == 304:
+        return cache["all_servers"]
+    response.raise_for_status()
+    all_servers = orjson.loads(response.content)["all_servers"]
+
+    cache = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "all_servers": all_servers,
+    }
+    try:
+        KNOWN_SERVERS_CACHE_PATH.write_bytes(orjson.dumps(cache))
+    except OSError as ex:
+        click.secho(f"Could not cache whitelist: {ex!r}", err=True)
+    return all_servers
+
+
+def _whitelist_changed(container: Container, remote_servers: FrozenSet[str]) -> bool:
+    try:
+        # fetch local list from container's synapse config
+        local_whitelist = yaml.load(
+            container.exec_run(["cat", SYNAPSE_CONFIG_PATH]).output, Loader=SafeLoader
+        )["federation_domain_whitelist"]
+
+        # if list didn't change, don't proceed to restart container
+        if local_whitelist and remote_servers == frozenset(local_whitelist):
+            return False
+
+        click.secho(f"Whitelist changed. Restarting. new_list={sorted(remote_servers)!r}")
+    except (KeyError, IndexError, APIError) as ex:
+        click.secho(
+            f"Error fetching container status: {ex!r}. Restarting anyway.",
+            err=True,
+        )
+    return True
+
+
+def read_user_activity(path: Path) -> UserActivityInfo:
+    """
+    Reads the user activity file. Errors while reading the file are raised
+    as they are, a corrupt file raises a `ValueError`.
+    """
+    data = path.read_bytes()
+    # files written by older versions are uncompressed
+    if data[:2] == GZIP_MAGIC_NUMBER:
+        try:
+            data = gzip.decompress(data)
+        # gzip.BadGzipFile only exists since Python 3.8, it's an OSError
+        except (OSError, EOFError, zlib.error) as ex:
+            raise ValueError(f"Corrupt gzip data: {ex!r}") from ex
+    return orjson.loads(data)
+
+
+def write_user_activity(path: Path, global_user_activity: UserActivityInfo) -> None:
+    """
+    Writes the gzip compressed user activity to a temporary file first and
+    replaces the old file afterwards. This way a crash while writing never
+    leaves a truncated file behind, even on power loss. The file keeps the mode of the old one.
+    """
+    try:
+        mode = stat.S_IMODE(path.stat().st_mode)
+    except FileNotFoundError:
+        mode = 0o644
+
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            # mkstemp creates the file with mode 0600
+            os.fchmod(tmp_file.fileno(), mode)
+            with gzip.GzipFile(fileobj=tmp_file, mode="wb", compresslevel=3) as gzip_file:
+                gzip_file.write(orjson.dumps(global_user_activity))
+            # make sure the data is on disk before it replaces the old file
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 
 def run_user_purger(
@@ -195,6 +340,8 @@ def update_user_activity(
     current_time = int(time.time())
     last_user_activity_update = global_user_activity["last_update"]
     network_to_users = global_user_activity["network_to_users"]
+    # files written by older versions don't cache the discovery rooms
+    discovery_rooms = global_user_activity.setdefault("discovery_rooms", {})
     network_to_due_users = dict()
     fetch_new_members = False
 
@@ -209,18 +356,35 @@ def update_user_activity(
 
     for network_key, user_activity in network_to_users.items():
         if fetch_new_members:
-            discovery_room = get_discovery_room(api, int(network_key))
+            is_cached_room = network_key in discovery_rooms
+            discovery_room = get_discovery_room(api, int(network_key), discovery_rooms)
             if discovery_room is None:
                 click.secho(
                     f"No discovery room found for network {network_key}, skipping.", fg="yellow"
                 )
                 continue
-            _fetch_new_members_for_network(
+            fetched = _fetch_new_members_for_network(
                 api=api,
                 user_activity=user_activity,
                 discovery_room=discovery_room,
                 current_time=current_time,
             )
+            # the cached room id might be stale, look it up once more
+            if not fetched and is_cached_room:
+                discovery_rooms.pop(network_key)
+                discovery_room = get_discovery_room(api, int(network_key), discovery_rooms)
+                if discovery_room is not None:
+                    _fetch_new_members_for_network(
+                        api=api,
+                        user_activity=user_activity,
+                        discovery_room=discovery_room,
+                        current_time=current_time,
+                    )
+
+        # nothing to check for networks without any (local) users
+        if not user_activity:
+            network_to_due_users[network_key] = []
+            continue
 
         network_to_due_users[network_key] = _update_user_activity_for_network(
             api=api, user_activity=user_activity, current_time=current_time
@@ -229,14 +393,23 @@ def update_user_activity(
     return network_to_due_users
 
 
-def get_discovery_room(api: GMatrixHttpApi, network_value: int) -> Optional[RoomInfo]:
+def get_discovery_room(
+    api: GMatrixHttpApi, network_value: int, discovery_rooms: Dict[str, str]
+) -> Optional[RoomInfo]:
+    """
+    Looks up the discovery room of the given network. Room ids don't change,
+    so they are cached in `discovery_rooms` and only fetched once.
+    """
 
-    server = urlparse(api.base_url).netloc
-    discovery_room_alias = make_room_alias(ChainID(network_value), DISCOVERY_DEFAULT_ROOM)
-    local_room_alias = f"#{discovery_room_alias}:{server}"
+    discovery_room_alias, local_room_alias, server = _room_alias_for(api.base_url, network_value)
+
+    room_id = discovery_rooms.get(str(network_value))
+    if room_id is not None:
+        return RoomInfo(room_id, discovery_room_alias, server)
 
     try:
         room_id = api.get_room_id(local_room_alias)
+        discovery_rooms[str(network_value)] = room_id
         return RoomInfo(room_id, discovery_room_alias, server)
     except MatrixError as ex:
         click.secho(f"Could not find room {discovery_room_alias} with error {ex}")
@@ -244,30 +417,47 @@ def get_discovery_room(api: GMatrixHttpApi, network_value: int) -> Optional[Room
     return None
 
 
+@functools.lru_cache(maxsize=None)
+def _room_alias_for(base_url: str, network_value: int) -> Tuple[str, str, str]:
+    """Returns the discovery room alias, its local alias and the server name"""
+    server = urlparse(base_url).netloc
+    discovery_room_alias = make_room_alias(ChainID(network_value), DISCOVERY_DEFAULT_ROOM)
+    return discovery_room_alias, f"#{discovery_room_alias}:{server}", server
+
+
+@functools.lru_cache(maxsize=8)
+def _local_member_pattern(server_name: str) -> Pattern[str]:
+    """Matches user ids of the given server, except for admin users"""
+    return re.compile(rf"(?!@admin)[^:]+:{re.escape(server_name)}")
+
+
 def _fetch_new_members_for_network(
     api: GMatrixHttpApi, user_activity: Dict[str, int], discovery_room: RoomInfo, current_time: int
-) -> None:
+) -> bool:
     try:
+        # The full member list is fetched, there is no way to only get the joins
+        # since the last run: the client API's `/members?at=` returns the room's
+        # membership at that point in time, not the changes after it.
         response = api._send(
             "GET",
-            api_path="/_synapse/admin/v1",
+            api_path=SYNAPSE_ADMIN_API_PATH,
             path=f"/rooms/{discovery_room.room_id}/members",
         )
-        server_name = urlparse(api.base_url).netloc
-        room_members = [
-            member
-            for member in response["members"]
-            if member.split(":")[1] == server_name and not member.startswith("@admin")
-        ]
+        # The admin API has no filter for the members' server,
+        # so the (usually larger) share of remote members is dropped here
+        local_member_pattern = _local_member_pattern(discovery_room.server_name)
+        room_members = list(filter(local_member_pattern.fullmatch, response["members"]))
 
         # Add new members with an overdue activity time
         # to trigger presence update later
+        overdue_last_seen = current_time - USER_PURGING_THRESHOLD - 1
         for user_id in room_members:
-            if user_id not in user_activity:
-                user_activity[user_id] = current_time - USER_PURGING_THRESHOLD - 1
+            user_activity.setdefault(user_id, overdue_last_seen)
 
     except MatrixError as ex:
         click.secho(f"Could not fetch members for {discovery_room.alias} with error {ex}")
+        return False
+    return True
 
 
 def _update_user_activity_for_network(
@@ -284,12 +474,12 @@ def _update_user_activity_for_network(
         f"Presences of {len(possible_candidates)} users will be fetched due to possible inactivity. This might take a while."
     )
     # presence updates are only run for possible due users.
-    # This helps to spread the load on the server as good as possible
-    # Since this script runs once a day, every day a couple of users are
-    # going to be updated rather than all at once
-    for user_id in possible_candidates:
+    # They are fetched on a thread pool with up to MAX_WORKERS requests
+    # in flight at a time, so the server sees a burst of lookups rather
+    # than an evenly spread load
+    for user_id, future in _run_concurrently(api.get_presence, possible_candidates, MAX_WORKERS):
         try:
-            response = api.get_presence(user_id)
+            response = future.result()
             # in rare cases there is no last_active_ago sent
             if "last_active_ago" in response:
                 last_active_ago = response["last_active_ago"] // 1000
@@ -303,8 +493,6 @@ def _update_user_activity_for_network(
 
         except MatrixError as ex:
             click.secho(f"Could not fetch user presence of {user_id}: {ex}")
-        finally:
-            time.sleep(0.1)
     return due_users
 
 
@@ -327,22 +515,73 @@ def _purge_inactive_users_for_network(
     user_activity: Dict[str, int],
     due_users: List[str],
 ) -> None:
-    for user_id in due_users:
+    deactivated_users = _deactivate_users(api, due_users)
+    now = int(time.time())
+    for user_id in deactivated_users:
+        last_ago = (now - user_activity[user_id]) / SECONDS_PER_DAY
+        click.secho(f"{user_id} deleted. Offline for {last_ago} days.")
+
+    # remove deleted users from the user_activity_file
+    for user_id in deactivated_users:
+        user_activity.pop(user_id, None)
+
+
+def _deactivate_users(api: GMatrixHttpApi, user_ids: List[str]) -> Set[str]:
+    """
+    Deactivates the given user accounts with {"erase": True}.
+    Synapse's admin API has no bulk deactivation endpoint, therefore
+    one request per user is sent.
+
+    :param api: api to its own server
+    :param user_ids: users to be deactivated
+    :return: users which have been deactivated successfully
+    """
+
+    def deactivate(user_id: str) -> Dict[str, Any]:
+        return api._send(
+            "POST",
+            f"/deactivate/{user_id}",
+            content=DEACTIVATE_CONTENT,
+            api_path=SYNAPSE_ADMIN_API_PATH,
+        )
+
+    deactivated_users = set()
+    for user_id, future in _run_concurrently(deactivate, user_ids, MAX_DEACTIVATION_WORKERS):
         try:
-            # delete user account and remove him from the user_activity_file
-            last_ago = (int(time.time()) - user_activity[user_id]) / (60 * 60 * 24)
-            api._send(
-                "POST",
-                f"/deactivate/{user_id}",
-                content={"erase": True},
-                api_path="/_synapse/admin/v1",
-            )
-            user_activity.pop(user_id, None)
-            click.secho(f"{user_id} deleted. Offline for {last_ago} days.")
+            future.result()
+            deactivated_users.add(user_id)
         except MatrixError as ex:
             click.secho(f"Could not delete user {user_id} with error {ex}")
-        finally:
-            time.sleep(0.1)
+    return deactivated_users
+
+
+def _run_concurrently(
+    func: Callable[[str], Dict[str, Any]], user_ids: List[str], max_workers: int
+) -> Iterator[Tuple[str, "Future[Dict[str, Any]]"]]:
+    """
+    Calls `func` for every user id on a thread pool. The requests are
+    independent per user, so they don't have to wait for each other's
+    round trip. The load on the server is bounded by `max_workers`.
+
+    :param func: request to run for a single user id
+    :param user_ids: user ids to run the request for
+    :param max_workers: maximum number of concurrent requests
+    :return: iterator of user ids with their futures, in order of completion
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_user_id = {executor.submit(func, user_id): user_id for user_id in user_ids}
+        for future in as_completed(future_to_user_id):
+            yield future_to_user_id[future], future
+
+
+def _retry_delay() -> Iterator[float]:
+    """
+    Exponential backoff with jitter between the retries of a failed request.
+    429 responses are retried by matrix_client itself, GMatrixHttpApi retries
+    on connection errors and 5xx responses using these delays.
+    """
+    for attempt in itertools.count():
+        yield min(MAX_RETRY_DELAY, 0.5 * 2**attempt) + random.random() * 0.1
 
 
 if __name__ == "__main__":
@@ -1,13 +1,25 @@
 import json
+import stat
 import string
 import time
+from pathlib import Path
 from random import randint
-from typing import Any, Dict
+from typing import Any, Dict, List
 
+import orjson
 import pytest
-from build.purger.purger import USER_PURGING_THRESHOLD, run_user_purger
+from build.purger.purger import (
+    GZIP_MAGIC_NUMBER,
+    USER_PURGING_THRESHOLD,
+    RoomInfo,
+    _fetch_new_members_for_network,
+    fetch_remote_whitelist,
+    read_user_activity,
+    run_user_purger,
+    write_user_activity,
+)
 from tests.file_templates import USER_PRESENCE_TEMPLATE
-from tests.utils import GMatrixHttpApiTest, create_user_activity_dict
+from tests.utils import GMatrixHttpApiTest, MockedResponse, create_user_activity_dict
 
 from raiden.constants import Networks
 
@@ -69,6 +81,24 @@ def mocked_matrix_api(
     )
 
 
+@pytest.fixture
+def whitelist_cache_path(tmp_path: Path, monkeypatch) -> Path:
+    cache_path = tmp_path / "known_servers.cache.json"
+    monkeypatch.setattr("build.purger.purger.KNOWN_SERVERS_CACHE_PATH", cache_path)
+    return cache_path
+
+
+def mock_whitelist_response(monkeypatch, response: MockedResponse) -> List[Dict[str, str]]:
+    sent_headers = []
+
+    def get(url, headers, timeout):
+        sent_headers.append(headers)
+        return response
+
+    monkeypatch.setattr("build.purger.purger.requests.get", get)
+    return sent_headers
+
+
 @pytest.mark.parametrize("last_update_in_days", [3])
 @pytest.mark.parametrize("due_users_count, active_users_count", [(5, 10)])
 @pytest.mark.parametrize("activity_changed_count", [2])
@@ -93,3 +123,129 @@ def test_due_users_get_kicked(
     ]
     # assert that there are no due users in the dictionary anymore
     assert len(due_user_items) == 0
+
+
+@pytest.mark.parametrize("last_update_in_days", [3])
+@pytest.mark.parametrize("due_users_count, active_users_count", [(5, 10)])
+@pytest.mark.parametrize("activity_changed_count", [2])
+@pytest.mark.parametrize("networks", [[Networks.GOERLI]])
+def test_cached_discovery_room_is_used(mocked_matrix_api, global_user_activity, networks):
+    network_key = str(networks[0].value)
+    room_id = "!cached:ownserver.com"
+    global_user_activity["discovery_rooms"] = {network_key: room_id}
+
+    new_global_user_activity = run_user_purger(mocked_matrix_api, global_user_activity)
+    # assert that the room id was not looked up again
+    assert new_global_user_activity["discovery_rooms"][network_key] == room_id
+
+
+@pytest.mark.parametrize("last_update_in_days", [3])
+@pytest.mark.parametrize("due_users_count, active_users_count", [(5, 10)])
+@pytest.mark.parametrize("activity_changed_count", [2])
+@pytest.mark.parametrize("networks", [[Networks.GOERLI]])
+def test_stale_discovery_room_is_replaced(mocked_matrix_api, global_user_activity, networks):
+    network_key = str(networks[0].value)
+    stale_room_id = "!stale:ownserver.com"
+    global_user_activity["discovery_rooms"] = {network_key: stale_room_id}
+    mocked_matrix_api.stale_room_ids.add(stale_room_id)
+
+    new_global_user_activity = run_user_purger(mocked_matrix_api, global_user_activity)
+    # assert that the room id was looked up again after fetching the members failed
+    room_id = new_global_user_activity["discovery_rooms"][network_key]
+    assert room_id != stale_room_id
+
+
+@pytest.mark.parametrize("last_update_in_days", [3])
+@pytest.mark.parametrize("due_users_count, active_users_count", [(5, 10)])
+@pytest.mark.parametrize("networks", [[Networks.GOERLI]])
+def test_plain_user_activity_file_is_upgraded(global_user_activity, tmp_path: Path):
+    user_activity_path = tmp_path / "user_activity.json"
+    # files written by older versions are uncompressed JSON
+    user_activity_path.write_bytes(orjson.dumps(global_user_activity))
+    user_activity_path.chmod(0o640)
+
+    assert read_user_activity(user_activity_path) == global_user_activity
+
+    write_user_activity(user_activity_path, global_user_activity)
+    assert user_activity_path.read_bytes()[:2] == GZIP_MAGIC_NUMBER
+    assert stat.S_IMODE(user_activity_path.stat().st_mode) == 0o640
+    assert read_user_activity(user_activity_path) == global_user_activity
+    # no temporary files are left behind
+    assert list(tmp_path.iterdir()) == [user_activity_path]
+
+
+def test_corrupt_user_activity_file_raises_value_error(tmp_path: Path):
+    user_activity_path = tmp_path / "user_activity.json"
+    write_user_activity(user_activity_path, {"last_update": 0, "network_to_users": {}})
+    data = bytearray(user_activity_path.read_bytes())
+    data[-3] ^= 0xFF
+    user_activity_path.write_bytes(bytes(data))
+
+    with pytest.raises(ValueError):
+        read_user_activity(user_activity_path)
+
+
+def test_only_local_members_are_added():
+    server_name = "ownserver.com:8448"
+    mocked_matrix_api = GMatrixHttpApiTest(f"https://{server_name}")
+    mocked_matrix_api.room_members = [
+        f"@local:{server_name}",
+        "@remote:otherserver.com",
+        f"@admin:{server_name}",
+        f"@admin_2:{server_name}",
+        "@other_port:ownserver.com:8449",
+        "@no_port:ownserver.com",
+        f"@other_host:x{server_name}",
+    ]
+    discovery_room = RoomInfo(f"!discovery:{server_name}", "discovery", server_name)
+    user_activity: Dict[str, int] = {}
+    current_time = int(time.time())
+
+    assert _fetch_new_members_for_network(
+        mocked_matrix_api, user_activity, discovery_room, current_time
+    )
+    # assert that only the local non-admin member got added as overdue
+    assert user_activity == {f"@local:{server_name}": current_time - USER_PURGING_THRESHOLD - 1}
+
+
+WHITELIST_URL = "https://example.com/known_servers.json"
+
+
+def test_fetch_remote_whitelist_caches_response(whitelist_cache_path, monkeypatch):
+    sent_headers = mock_whitelist_response(
+        monkeypatch,
+        MockedResponse(200, b'{"all_servers": ["a.com", "b.com"]}', {"ETag": '"v1"'}),
+    )
+
+    assert fetch_remote_whitelist(WHITELIST_URL) == ["a.com", "b.com"]
+    assert sent_headers == [{}]
+    cache = orjson.loads(whitelist_cache_path.read_bytes())
+    assert cache["url"] == WHITELIST_URL
+    assert cache["etag"] == '"v1"'
+    assert cache["all_servers"] == ["a.com", "b.com"]
+
+
+def test_fetch_remote_whitelist_uses_cache_if_not_modified(whitelist_cache_path, monkeypatch):
+    whitelist_cache_path.write_bytes(
+        orjson.dumps({"url": WHITELIST_URL, "etag": '"v1"', "all_servers": ["a.com"]})
+    )
+    sent_headers = mock_whitelist_response(monkeypatch, MockedResponse(304))
+
+    assert fetch_remote_whitelist(WHITELIST_URL) == ["a.com"]
+    assert sent_headers == [{"If-None-Match": '"v1"'}]
+
+
+@pytest.mark.parametrize(
+    "cache_content", [b"[1, 2]", orjson.dumps({"url": WHITELIST_URL, "etag": '"v1"'})]
+)
+def test_fetch_remote_whitelist_ignores_unusable_cache(
+    whitelist_cache_path, monkeypatch, cache_content
+):
+    whitelist_cache_path.write_bytes(cache_content)
+    sent_headers = mock_whitelist_response(
+        monkeypatch, MockedResponse(200, b'{"all_servers": ["a.com"]}')
+    )
+
+    assert fetch_remote_whitelist(WHITELIST_URL) == ["a.com"]
+    # assert that no 304 was asked for without a cached list to fall back to
+    assert sent_headers == [{}]
@@ -15,6 +15,8 @@ class GMatrixHttpApiTest(GMatrixHttpApi):
         self.server_name = server_name
         self.user_presence = user_presence
         self.activity_change = activity_change
+        self.stale_room_ids = set()
+        self.room_members = []
 
     def get_room_id(self, room_alias) -> str:
         letters = string.ascii_lowercase
@@ -36,7 +38,19 @@ class GMatrixHttpApiTest(GMatrixHttpApi):
     def _send(
         self, method, path, content=None, query_params=None, headers=None, api_path="",
     ):
-        return {"members": []}
+        if any(room_id in path for room_id in self.stale_room_ids):
+            raise MatrixRequestError(code=404, content="Room not found")
+        return {"members": self.room_members}
+
+
+class MockedResponse:
+    def __init__(self, status_code: int, content: bytes = b"", headers: Dict[str, str] = None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self) -> None:
+        pass
 
 
 def create_user_activity_dict(size: int, lower_bound: int, upper_bound: int) -> Dict[str, int]: